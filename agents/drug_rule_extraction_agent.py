@@ -1,37 +1,110 @@
 import re
 import os
-import spacy
+import hashlib
+import pathlib
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 from pypdf import PdfReader
-from typing import Dict, Any, List, Optional
+from typing import Dict, Any, List, Optional, Tuple
 from utils.logger import drug_rule_extraction_logger
-from utils.schemas import TrialRules
-from langchain_ollama import OllamaLLM
-from utils.parsing import robust_json_load
+from utils.schemas import TrialRules, ExtractedRules
+from utils.llm import generate_all
+from utils.parsing import parse_model
+from utils.nlp import get_nlp, ground_texts
 
-# Global cache for NLP model to avoid reloading
-_nlp = None
+# PDFs with at least this many pages are split across worker processes
+PDF_PARALLEL_MIN_PAGES = 16
+PDF_MAX_WORKERS = min(os.cpu_count() or 1, 6)
 
-def get_nlp():
-    global _nlp
-    if _nlp is None:
-        try:
-            drug_rule_extraction_logger.log("Loading SciSpaCy model en_core_sci_lg...")
-            _nlp = spacy.load("en_core_sci_lg")
-            drug_rule_extraction_logger.log("Model loaded successfully.")
-        except OSError:
-            drug_rule_extraction_logger.log("SciSpaCy model not found, skipping entity grounding.")
-            _nlp = None
-    return _nlp
+def _extract_page_range(args: Tuple[str, int, int]) -> List[str]:
+    """Worker: extract the text of pages [start, stop) of one PDF."""
+    filepath, start, stop = args
+    reader = PdfReader(filepath)
+    return [reader.pages[i].extract_text() or "" for i in range(start, stop)]
+
+def extract_pdf_text(filepath: str, max_workers: int = PDF_MAX_WORKERS) -> str:
+    """
+    Extract PDF text page by page. Large PDFs are split into contiguous page ranges
+    that are extracted in parallel processes (pypdf extraction is CPU-bound).
+    """
+    reader = PdfReader(filepath)
+    n_pages = len(reader.pages)
+    if n_pages < PDF_PARALLEL_MIN_PAGES or max_workers < 2:
+        pages = [page.extract_text() or "" for page in reader.pages]
+    else:
+        step = -(-n_pages // max_workers)
+        ranges = [(filepath, start, min(start + step, n_pages)) for start in range(0, n_pages, step)]
+        with ProcessPoolExecutor(max_workers=len(ranges)) as executor:
+            pages = [page for chunk in executor.map(_extract_page_range, ranges) for page in chunk]
+    return "".join(page + "\n" for page in pages if page)
+
+# Parsed LLM extractions are cached per document content; bump PROMPT_VERSION when the prompt changes
+RULE_CACHE_DIR = pathlib.Path(".cache/trial_rules")
+PROMPT_VERSION = 2
+
+# Only the eligibility sections of a document are sent to the LLM
+_SECTION_RE = re.compile(r"(SELECTION OF PATIENTS|INCLUSION CRITERIA|EXCLUSION CRITERIA|ELIGIBILITY)", re.IGNORECASE)
+SECTION_WINDOW_CHARS = 3000
+SECTION_MAX_CHARS = 8000
+
+def rule_cache_path(filepath: str) -> Optional[pathlib.Path]:
+    """Cache file for a document's extraction, or None if the document can't be read."""
+    try:
+        digest = hashlib.sha256(pathlib.Path(filepath).read_bytes()).hexdigest()
+    except OSError as e:
+        drug_rule_extraction_logger.log(f"Rule cache disabled for {filepath}: {e}")
+        return None
+    return RULE_CACHE_DIR / f"{digest}_v{PROMPT_VERSION}.json"
+
+def load_cached_rules(cache_path: Optional[pathlib.Path]) -> Optional[ExtractedRules]:
+    """Cached extraction, or None (= re-extract) if missing, unreadable or invalid."""
+    if cache_path is None or not cache_path.exists():
+        return None
+    try:
+        # pydantic's ValidationError is a ValueError
+        return ExtractedRules.model_validate_json(cache_path.read_bytes())
+    except (OSError, ValueError) as e:
+        drug_rule_extraction_logger.log(f"Ignoring unusable rule cache {cache_path}: {e}")
+        return None
+
+def save_cached_rules(cache_path: Optional[pathlib.Path], extracted: ExtractedRules) -> None:
+    """Write the cache atomically (temp file + rename) so a crash never leaves a partial entry."""
+    if cache_path is None:
+        return
+    tmp_path = None
+    try:
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            f.write(extracted.model_dump_json())
+        os.replace(tmp_path, cache_path)
+    except OSError as e:
+        drug_rule_extraction_logger.log(f"Could not write rule cache {cache_path}: {e}")
+        if tmp_path and os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def select_eligibility_text(raw_text: str, window: int = SECTION_WINDOW_CHARS, max_chars: int = SECTION_MAX_CHARS) -> str:
+    """
+    Take a window of text after every eligibility heading, merge overlapping windows
+    and join them with "---" separators (capped at max_chars).
+    Falls back to the start of the document if no heading is found.
+    """
+    spans = []
+    for match in _SECTION_RE.finditer(raw_text):
+        start, stop = match.start(), min(match.start() + window, len(raw_text))
+        if spans and start <= spans[-1][1]:
+            spans[-1][1] = max(spans[-1][1], stop)
+        else:
+            spans.append([start, stop])
+    if not spans:
+        return raw_text[:max_chars]
+    return "\n---\n".join(raw_text[start:stop] for start, stop in spans)[:max_chars]
 
 def extract_text_from_file(filepath: str) -> str:
     text = ""
     if filepath.endswith(".pdf"):
         try:
-            reader = PdfReader(filepath)
-            for page in reader.pages:
-                page_text = page.extract_text()
-                if page_text:
-                    text += page_text + "\n"
+            text = extract_pdf_text(filepath)
         except Exception as e:
             drug_rule_extraction_logger.log(f"Error reading PDF {filepath}: {e}")
     elif filepath.endswith(".txt"):
@@ -44,27 +117,24 @@ def extract_text_from_file(filepath: str) -> str:
 
 def ground_entities(items: Any) -> List[str]:
     """Ground extraction names to canonical medical entities."""
-    grounded = []
-    nlp = get_nlp()
+    names = []
     if isinstance(items, list):
         for item in items:
             if isinstance(item, dict):
                 name = item.get("name")
             else:
                 name = str(item)
-            
             if name:
-                if nlp:
-                    doc = nlp(name)
-                    if doc.ents:
-                        grounded.append(doc.ents[0].text.strip().title())
-                    else:
-                        grounded.append(name.strip().title())
-                else:
-                    grounded.append(name.strip().title())
-    return list(set(grounded))
-
-def drug_rule_extraction_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+                names.append(name)
+
+    nlp = get_nlp()
+    if nlp:
+        grounded = ground_texts(nlp, names)
+    else:
+        grounded = [name.strip().title() for name in names]
+    return list(dict.fromkeys(grounded))
+
+async def drug_rule_extraction_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     Generalized Drug Rule Extraction using LLaMA 3.1 + SciSpaCy grounding.
     Extracts structured eligibility criteria from any document with source evidence.
@@ -82,24 +152,28 @@ def drug_rule_extraction_agent(state: Dict[str, Any]) -> Dict[str, Any]:
 
     drug_rule_extraction_logger.log(f"Processing {len(files)} trial documents...")
     
-    llm = OllamaLLM(model="llama3.1:latest", temperature=0)
-    
     all_inclusion = {"diagnoses": [], "labs": {}, "medications": []}
     all_exclusion = {"diagnoses": [], "labs": {}, "medications": []}
 
+    # Build every prompt first so the LLM calls can run concurrently
+    extractions = {}
+    pending = []
+    prompts = []
     for trial_file in files:
         filepath = os.path.join(data_dir, trial_file)
+        cache_path = rule_cache_path(filepath)
+        cached = load_cached_rules(cache_path)
+        if cached is not None:
+            drug_rule_extraction_logger.log(f"Using cached rule extraction for {trial_file}")
+            extractions[trial_file] = cached
+            continue
+
         raw_text = extract_text_from_file(filepath)
         if not raw_text:
             continue
 
-        # Extract selection of patients section if possible
-        text_chunk = raw_text
-        start_idx = text_chunk.lower().find("selection of patients")
-        if start_idx != -1:
-            text_chunk = text_chunk[start_idx:start_idx+15000]
-        else:
-            text_chunk = text_chunk[:15000]
+        # Extract the selection of patients / eligibility sections if possible
+        text_chunk = select_eligibility_text(raw_text)
 
         prompt = f"""
         Extract structured Clinical Trial Eligibility Criteria. 
@@ -125,18 +199,38 @@ def drug_rule_extraction_agent(state: Dict[str, Any]) -> Dict[str, Any]:
         TEXT:
         {text_chunk}
         """
+        pending.append((trial_file, cache_path))
+        prompts.append(prompt)
 
+    responses = await generate_all(prompts)
+
+    for (trial_file, cache_path), response in zip(pending, responses):
         try:
-            response = llm.invoke(prompt)
-            extracted = robust_json_load(response, component_name=f"RuleExtraction({trial_file})")
+            if isinstance(response, BaseException):
+                raise response
+            extracted = parse_model(ExtractedRules, response, component_name=f"RuleExtraction({trial_file})")
             
-            if not extracted:
+            # Every field has a default, so an empty/unrelated object still validates;
+            # treat it as a failure so it is never cached
+            if extracted is None or not (extracted.inclusion or extracted.exclusion):
                 drug_rule_extraction_logger.log(f"CRITICAL: Extraction failed for {trial_file}. Raw LLM output failed to parse.")
                 continue
 
+            extractions[trial_file] = extracted
+            save_cached_rules(cache_path, extracted)
+
+        except Exception as e:
+            drug_rule_extraction_logger.log(f"Extraction failed for {trial_file}: {e}")
+
+    # Merge in document order so cached and fresh extractions combine the same way
+    for trial_file in files:
+        extracted = extractions.get(trial_file)
+        if extracted is None:
+            continue
+        try:
             # MERGE RESULTS
-            inc = extracted.get("inclusion", {})
-            exc = extracted.get("exclusion", {})
+            inc = extracted.inclusion
+            exc = extracted.exclusion
 
             # Age/Gender/Weight (Take first available or merge min/max conservatively)
             if "age" in inc and inc["age"]: 
@@ -163,12 +257,12 @@ def drug_rule_extraction_agent(state: Dict[str, Any]) -> Dict[str, Any]:
                     all_exclusion["labs"][name] = {"min": lab.get("min"), "max": lab.get("max"), "quote": lab.get("quote")}
 
         except Exception as e:
-            drug_rule_extraction_logger.log(f"Extraction failed for {trial_file}: {e}")
+            drug_rule_extraction_logger.log(f"Merging extraction failed for {trial_file}: {e}")
 
     # Final Deduplication
-    all_inclusion["diagnoses"] = list(set(all_inclusion["diagnoses"]))
-    all_exclusion["diagnoses"] = list(set(all_exclusion["diagnoses"]))
-    all_exclusion["medications"] = list(set(all_exclusion["medications"]))
+    all_inclusion["diagnoses"] = list(dict.fromkeys(all_inclusion["diagnoses"]))
+    all_exclusion["diagnoses"] = list(dict.fromkeys(all_exclusion["diagnoses"]))
+    all_exclusion["medications"] = list(dict.fromkeys(all_exclusion["medications"]))
 
     trial_id = "GENERALIZED_RULES"
     rules = TrialRules(
@@ -1,90 +1,187 @@
+import bisect
 import json
-from typing import Dict, Any
-from langchain_ollama import OllamaLLM
+from typing import Dict, Any, List, Tuple
+from pydantic import ValidationError
+from utils.llm import generate_all, LLM_NUM_CTX
 from utils.logger import eligibility_reasoning_logger
-from utils.schemas import EligibilityResult
+from utils.schemas import PatientEligibility
 from utils.parsing import robust_json_load
 
-def eligibility_reasoning_agent(state: Dict[str, Any]) -> Dict[str, Any]:
-    """
-    Use LLaMA 3.1 for inclusion evaluation with robust JSON parsing.
-    Only runs for patients who passed the Exclusion Router.
-    """
-    patients = state.get("eligible_patients", [])
-    trial_rules = state.get("trial_rules", {})
+# Patients are packed into shared prompts so the inclusion criteria are only sent once per batch.
+# A batch's whole prompt plus the expected answers has to fit in the LLM context window.
+MAX_BATCH_SIZE = 16
+# Headroom for the token estimates being off
+CONTEXT_MARGIN_TOKENS = 512
+# Patients are first split into short/medium/long bins by expected response length (tokens),
+# so a batch doesn't wait on one patient with a much longer answer than the others
+LENGTH_BIN_EDGES = (150, 300)
 
-    # Assume one trial set
-    trial_id = list(trial_rules.keys())[0] if trial_rules else "GENERALIZED_RULES"
-    rules = trial_rules.get(trial_id, {})
-    inclusion = rules.get("inclusion", {})
+def estimate_tokens(text: str) -> int:
+    """Cheap token estimate (~3 characters per token, JSON is token-dense)."""
+    return len(text) // 3 + 1
 
-    # Initialize modern OllamaLLM
-    llm = OllamaLLM(model="llama3.1:latest", temperature=0)
+def patient_prompt_tokens(patient: Dict[str, Any]) -> int:
+    """Tokens one patient adds to the prompt, measured on the same indented JSON the prompt embeds."""
+    return estimate_tokens(json.dumps([patient], indent=2))
 
-    for patient in patients:
-        prompt_input = {
-            "patient_data": {
-                "age": patient.get("age"),
-                "gender": patient.get("gender"),
-                "diagnoses": patient.get("diagnoses"),
-                "labs": patient.get("labs"),
-                "medications": patient.get("medications")
-            },
-            "inclusion_criteria": inclusion
-        }
+def predict_len(patient: Dict[str, Any]) -> int:
+    """Cheap predictor of the response length (tokens) for one patient."""
+    return 50 + 8 * len(patient.get("diagnoses") or []) + 6 * len(patient.get("labs") or {})
+
+def bin_by_length(items: List[Dict[str, Any]], edges: Tuple[int, ...] = LENGTH_BIN_EDGES) -> List[List[Dict[str, Any]]]:
+    """
+    Split items into bins by predicted response length (bin k holds lengths below edges[k]).
+    Patients of similar length share one bin, so small cohorts still end up in a single batch.
+    """
+    bins = [[] for _ in range(len(edges) + 1)]
+    for item in items:
+        bins[bisect.bisect_right(edges, predict_len(item))].append(item)
+    return [b for b in bins if b]
+
+def pack_batches(items: List[Dict[str, Any]], max_tokens: int, max_size: int = MAX_BATCH_SIZE) -> List[List[Dict[str, Any]]]:
+    """
+    Sort items by estimated size and pack them into batches whose patient data plus
+    expected answers (predict_len) stay under max_tokens, so each batch holds patients of similar size.
+    """
+    batches = []
+    current = []
+    current_tokens = 0
+    costs = ((patient_prompt_tokens(i) + predict_len(i), i) for i in items)
+    for tokens, item in sorted(costs, key=lambda x: x[0]):
+        if current and (current_tokens + tokens > max_tokens or len(current) >= max_size):
+            batches.append(current)
+            current = []
+            current_tokens = 0
+        current.append(item)
+        current_tokens += tokens
+    if current:
+        batches.append(current)
+    return batches
 
-        prompt = f"""
+def build_prompt(inclusion: Dict[str, Any], batch: List[Dict[str, Any]]) -> str:
+    return f"""
         You are a clinical trial eligibility reasoning agent.
-        Determine if the patient strictly meets the INCLUSION criteria.
+        Determine for EACH patient if they strictly meet the INCLUSION criteria.
         Exclusion criteria have already been passed.
 
-        INPUT DATA:
-        {json.dumps(prompt_input, indent=2)}
+        INCLUSION CRITERIA:
+        {json.dumps(inclusion, indent=2)}
+
+        PATIENTS:
+        {json.dumps(batch, indent=2)}
 
         INSTRUCTIONS:
-        1. Compare patient data against inclusion criteria.
+        1. Compare each patient's data against the inclusion criteria.
         2. Rule: If data is missing for inclusion, mark as Eligible (True) but note it in reasoning.
         3. Assign a confidence score (0.0 - 1.0).
         4. Provide step-by-step reasoning.
+        5. Return exactly one result per patient, with the same patient_id.
 
         OUTPUT VALID JSON ONLY:
         {{
-          "eligible": boolean,
-          "confidence": float,
-          "reasoning": ["point 1", "point 2", ...],
-          "summary": "Short summary string"
+          "results": [
+            {{
+              "patient_id": "string",
+              "eligible": boolean,
+              "confidence": float,
+              "reasoning": ["point 1", "point 2", ...],
+              "summary": "Short summary string"
+            }}
+          ]
         }}
         """
-        
+
+def failed_result(message: str) -> Dict[str, Any]:
+    return {
+        "eligible": False,
+        "confidence": 0.0,
+        "reasoning": [f"LLM processing failed: {message}"],
+        "summary": "Error during reasoning stage."
+    }
+
+async def eligibility_reasoning_agent(state: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Use LLaMA 3.1 for inclusion evaluation with robust JSON parsing.
+    Only runs for patients who passed the Exclusion Router.
+    """
+    patients = state.get("eligible_patients", [])
+    trial_rules = state.get("trial_rules", {})
+
+    # Assume one trial set
+    trial_id = list(trial_rules.keys())[0] if trial_rules else "GENERALIZED_RULES"
+    rules = trial_rules.get(trial_id, {})
+    inclusion = rules.get("inclusion", {})
+
+    patient_data = [
+        {
+            "patient_id": patient.get("patient_id"),
+            "age": patient.get("age"),
+            "gender": patient.get("gender"),
+            "diagnoses": patient.get("diagnoses"),
+            "labs": patient.get("labs"),
+            "medications": patient.get("medications")
+        }
+        for patient in patients
+    ]
+    # Token budget left for patients once the shared part of the prompt (criteria + instructions) is counted
+    max_batch_tokens = LLM_NUM_CTX - estimate_tokens(build_prompt(inclusion, [])) - CONTEXT_MARGIN_TOKENS
+
+    # Each length bin is packed separately; all batches are then sent concurrently
+    batches = [batch for length_bin in bin_by_length(patient_data) for batch in pack_batches(length_bin, max_batch_tokens)]
+    prompts = [build_prompt(inclusion, batch) for batch in batches]
+
+    eligibility_reasoning_logger.log(f"Evaluating {len(patients)} patients in {len(prompts)} batched prompts...")
+    responses = await generate_all(prompts)
+
+    results_by_id = {}
+    for batch, response in zip(batches, responses):
+        batch_ids = [str(p["patient_id"]) for p in batch]
         try:
-            response = llm.invoke(prompt)
-            result = robust_json_load(response, component_name=f"Reasoning(PID:{patient.get('patient_id')})")
-            
-            if not result:
+            if isinstance(response, BaseException):
+                raise response
+            data = robust_json_load(response, component_name=f"Reasoning(PIDs:{batch_ids})")
+            items = data.get("results") if isinstance(data, dict) else None
+
+            if not isinstance(items, list):
                 # Log the raw response for debugging P005 style errors
-                eligibility_reasoning_logger.log(f"DEBUG: Raw response for {patient.get('patient_id')} failed parsing: {response}")
+                eligibility_reasoning_logger.log(f"DEBUG: Raw response for {batch_ids} failed parsing: {response}")
                 raise ValueError("JSON matching/parsing failed for LLM response")
-            
-            # Validation with defaults
-            eligibility_result = EligibilityResult(
-                eligible=result.get("eligible", False),
-                confidence=result.get("confidence", 0.0),
-                reasoning=result.get("reasoning", ["Reasoning could not be parsed"]),
-                summary=result.get("summary", "No summary provided.")
-            )
-            patient["eligibility_result"] = eligibility_result.model_dump()
 
         except Exception as e:
-            eligibility_reasoning_logger.log(f"LLM Error for patient {patient.get('patient_id')}: {e}")
-            patient["eligibility_result"] = {
-                "eligible": False,
-                "confidence": 0.0,
-                "reasoning": [f"LLM processing failed: {str(e)}"],
-                "summary": "Error during reasoning stage."
-            }
+            eligibility_reasoning_logger.log(f"LLM Error for patients {batch_ids}: {e}")
+            for pid in batch_ids:
+                results_by_id[pid] = failed_result(str(e))
+            continue
+
+        # Validate each result on its own so one malformed item only fails its own patient.
+        # Only ids from this batch are accepted (first answer wins), so a hallucinated
+        # or repeated id cannot overwrite another patient's result.
+        answered = set()
+        for item in items:
+            pid = str(item.get("patient_id")) if isinstance(item, dict) else None
+            if pid not in batch_ids or pid in answered:
+                eligibility_reasoning_logger.log(f"LLM Error for patients {batch_ids}: Ignoring result for unexpected or duplicate patient {pid}")
+                continue
+            answered.add(pid)
+            try:
+                result = PatientEligibility.model_validate(item)
+            except ValidationError as e:
+                eligibility_reasoning_logger.log(f"LLM Error for patient {pid}: Invalid result in batched response: {e}")
+                results_by_id[pid] = failed_result(f"Invalid result in batched response ({e.error_count()} validation errors)")
+                continue
+            results_by_id[pid] = result.model_dump(exclude={"patient_id"})
+
+    for patient in patients:
+        pid = str(patient.get("patient_id"))
+        # Results were validated (with defaults) against PatientEligibility
+        result = results_by_id.get(pid)
+        if result is None:
+            eligibility_reasoning_logger.log(f"LLM Error for patient {pid}: No result returned for patient in batched response")
+            result = failed_result("No result returned for patient in batched response")
+        patient["eligibility_result"] = result
 
         res = patient["eligibility_result"]
-        eligibility_reasoning_logger.log(f"Patient {patient.get('patient_id')}: Eligible={res['eligible']}, Conf={res['confidence']}")
+        eligibility_reasoning_logger.log(f"Patient {pid}: Eligible={res['eligible']}, Conf={res['confidence']}")
 
     state["eligible_patients"] = patients
     return state
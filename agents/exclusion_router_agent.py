@@ -1,130 +1,188 @@
-from typing import Dict, Any
+import os
+import numpy as np
+import pandas as pd
+from typing import Dict, Any, Callable, List, Tuple
 from utils.logger import exclusion_router_logger
 
+# Audit mode: report every failed check per patient. By default a patient stops being
+# checked after the first hit (only the exclusion decision is needed for routing).
+COLLECT_ALL_REASONS = os.environ.get("COLLECT_ALL_REASONS", "0") == "1"
+
+def lab_matrix(lab_values: pd.DataFrame, n_patients: int, lab_rules: List[Tuple[str, Dict[str, Any]]]) -> np.ndarray:
+    """
+    Patients x rule-labs matrix of lab values (NaN where a patient has no value),
+    scattered from the long-form lab table. Column j holds the lab named by lab_rules[j].
+    """
+    values = np.full((n_patients, len(lab_rules)), np.nan)
+    lab_names = lab_values["lab_name"]
+    for j, (lab_name, _) in enumerate(lab_rules):
+        rows = lab_values[lab_names == lab_name]
+        values[rows["patient_idx"].to_numpy(), j] = rows["value"].to_numpy()
+    return values
+
+def numeric_bound(value: Any, label: str) -> float:
+    """
+    Rule bound as a float; NaN (= no bound) when missing or not numeric.
+    Bounds come from LLM extraction, so e.g. "<13 g/dL" is logged and ignored
+    instead of failing the whole routing step.
+    """
+    if value is None:
+        return np.nan
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        exclusion_router_logger.log(f"Ignoring non-numeric rule bound {label}: {value!r}")
+        return np.nan
+
+def bound_arrays(lab_rules: List[Tuple[str, Dict[str, Any]]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Min/max bounds of each lab rule as float arrays (NaN = no bound)."""
+    mins = np.array([numeric_bound(b.get("min"), f"{name} min") for name, b in lab_rules], dtype="float64")
+    maxs = np.array([numeric_bound(b.get("max"), f"{name} max") for name, b in lab_rules], dtype="float64")
+    return mins, maxs
+
 def exclusion_router_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     Check exclusion criteria for all patients using structured Rules (with Evidence).
     Deterministic Logic:
     - If ANY exclusion criterion matches (and IS present) -> Exclude.
     - Missing data -> DO NOT exclude (preserve partial record).
+    Each check is evaluated for all patients at once as a boolean mask;
+    reason strings are only built for the patients that hit.
+    Checks run cheapest-first; unless COLLECT_ALL_REASONS is set, patients
+    that already hit are skipped by the remaining checks.
     """
     patients = state.get("transformed_patients", [])
+    # Columnar features built by feature engineering (row i = patients[i])
+    features = state["patient_features"]
     trial_rules = state.get("trial_rules", {})
 
     # Assume one trial set (Generalized Rules)
     trial_id = list(trial_rules.keys())[0] if trial_rules else "GENERALIZED_RULES"
     rules = trial_rules.get(trial_id, {})
-    
+
     inclusion = rules.get("inclusion", {})
     exclusion = rules.get("exclusion", {})
 
+    # Rule-derived values are the same for every patient, so prepare them once
+    age_rule = inclusion.get("age", {})
+    gender_rule = inclusion.get("gender", {})
+    weight_rule = inclusion.get("weight", {})
+    # From LLM extraction, diagnoses are a list of strings (grounded)
+    exclusion_diagnoses = frozenset(d.lower() for d in exclusion.get("diagnoses", []))
+    exclusion_meds = frozenset(m.lower() for m in exclusion.get("medications", []))
+    inclusion_labs = list(inclusion.get("labs", {}).items())
+    exclusion_labs = list(exclusion.get("labs", {}).items())
+
+    ages = features["age"]
+    genders = features["gender"].fillna("").str.lower()
+    weights = features["weight"]
+    lab_values = lab_matrix(state["lab_values"], len(patients), inclusion_labs + exclusion_labs)
+
+    reasons: List[List[str]] = [[] for _ in patients]
+    excluded = np.zeros(len(patients), dtype=bool)
+
+    def still_open() -> np.ndarray:
+        """Patients the next check still has to look at."""
+        return np.ones(len(patients), dtype=bool) if COLLECT_ALL_REASONS else ~excluded
+
+    def add_reasons(mask: Any, make_reason: Callable[[int], str]) -> None:
+        hits = np.asarray(mask, dtype=bool) & still_open()
+        for i in np.flatnonzero(hits):
+            reasons[i].append(make_reason(i))
+        np.logical_or(excluded, hits, out=excluded)
+
+    # 1. Check Age
+    # ------------
+    # (numeric/string compares first, then set intersections, then lab scans)
+    if isinstance(age_rule, dict):
+        age_min = age_rule.get("min")
+        age_max = age_rule.get("max")
+        # Compare against the coerced bound; reasons keep the rule's own value
+        age_min_num = numeric_bound(age_min, "age min")
+        age_max_num = numeric_bound(age_max, "age max")
+        if not np.isnan(age_min_num):
+            add_reasons(ages < age_min_num, lambda i: f"Age {patients[i]['age']} < Required Min {age_min}")
+        if not np.isnan(age_max_num):
+            add_reasons(ages > age_max_num, lambda i: f"Age {patients[i]['age']} > Required Max {age_max}")
+
+    # 2. Check Gender
+    # ---------------
+    if isinstance(gender_rule, dict):
+        req_gender = gender_rule.get("value")
+        if req_gender and req_gender.lower() != "any":
+            add_reasons((genders != "") & (genders != req_gender.lower()),
+                        lambda i: f"Gender {patients[i]['gender']} != Required {req_gender}")
+
+    # 3. Check Weight
+    # ---------------
+    # For now demographics weight
+    if isinstance(weight_rule, dict):
+        w_min = weight_rule.get("min")
+        w_max = weight_rule.get("max")
+        w_min_num = numeric_bound(w_min, "weight min")
+        w_max_num = numeric_bound(w_max, "weight max")
+        if not np.isnan(w_min_num):
+            add_reasons(weights < w_min_num, lambda i: f"Weight {patients[i]['weight']} < Required Min {w_min}")
+        if not np.isnan(w_max_num):
+            add_reasons(weights > w_max_num, lambda i: f"Weight {patients[i]['weight']} > Required Max {w_max}")
+
+    # 4. Check Explicit Exclusion Diagnoses
+    # -------------------------------------
+    if exclusion_diagnoses:
+        open_rows = still_open()
+        common_diag = [
+            diagnoses & exclusion_diagnoses if open_rows[i] else frozenset()
+            for i, diagnoses in enumerate(features["diagnoses_lc"])
+        ]
+        add_reasons([bool(c) for c in common_diag], lambda i: f"Excluded Diagnoses found: {list(common_diag[i])}")
+
+    # 5. Check Explicit Exclusion Medications
+    # ---------------------------------------
+    if exclusion_meds:
+        open_rows = still_open()
+        common_meds = [
+            meds & exclusion_meds if open_rows[i] else frozenset()
+            for i, meds in enumerate(features["medications_lc"])
+        ]
+        add_reasons([bool(c) for c in common_meds], lambda i: f"Excluded Medications found: {list(common_meds[i])}")
+
+    # 6. Check Lab Thresholds
+    # -----------------------
+    # Check both inclusion labs (failure = exclusion) and exclusion labs (hit = exclusion)
+    # Handle inclusion lab failures
+    n_inc = len(inclusion_labs)
+    inc_vals = lab_values[:, :n_inc]
+    inc_min, inc_max = bound_arrays(inclusion_labs)
+    below_min = inc_vals < inc_min
+    above_max = inc_vals > inc_max
+    for j, (lab_name, bounds) in enumerate(inclusion_labs):
+        add_reasons(below_min[:, j], lambda i: f"Inclusion failed: {lab_name} {patients[i]['labs'][lab_name]} < min {bounds['min']}")
+        add_reasons(above_max[:, j], lambda i: f"Inclusion failed: {lab_name} {patients[i]['labs'][lab_name]} > max {bounds['max']}")
+
+    # Handle exclusion lab hits
+    # Hit if in range of exclusion; a missing bound leaves that side open
+    exc_vals = lab_values[:, n_inc:]
+    exc_min, exc_max = bound_arrays(exclusion_labs)
+    has_min = ~np.isnan(exc_min)
+    has_max = ~np.isnan(exc_max)
+    in_range = ((exc_vals >= exc_min) | ~has_min) & ((exc_vals <= exc_max) | ~has_max) & (has_min | has_max)
+    for j, (lab_name, bounds) in enumerate(exclusion_labs):
+        if has_min[j] and has_max[j]:
+            make_reason = lambda i: f"Exclusion Lab hit: {lab_name} {patients[i]['labs'][lab_name]} is in excluded range [{bounds['min']}, {bounds['max']}]"
+        elif has_min[j]:
+            make_reason = lambda i: f"Exclusion Lab hit: {lab_name} {patients[i]['labs'][lab_name]} >= excluded min {bounds['min']}"
+        else:
+            make_reason = lambda i: f"Exclusion Lab hit: {lab_name} {patients[i]['labs'][lab_name]} <= excluded max {bounds['max']}"
+        add_reasons(in_range[:, j], make_reason)
+
     eligible_patients = []
     excluded_patients = []
 
-    for patient in patients:
-        exclusion_hit = False
-        reasons = []
-
-        # 1. Check Age
-        # ------------
-        patient_age = patient.get("age")
-        age_rule = inclusion.get("age", {})
-        if patient_age is not None and isinstance(age_rule, dict):
-            age_min = age_rule.get("min")
-            age_max = age_rule.get("max")
-            
-            if age_min is not None and patient_age < age_min:
-                exclusion_hit = True
-                reasons.append(f"Age {patient_age} < Required Min {age_min}")
-            if age_max is not None and patient_age > age_max:
-                exclusion_hit = True
-                reasons.append(f"Age {patient_age} > Required Max {age_max}")
-
-        # 2. Check Gender
-        # ---------------
-        patient_gender = patient.get("gender")
-        gender_rule = inclusion.get("gender", {})
-        if patient_gender and isinstance(gender_rule, dict):
-            req_gender = gender_rule.get("value")
-            if req_gender and req_gender.lower() != "any":
-                if patient_gender.lower() != req_gender.lower():
-                    exclusion_hit = True
-                    reasons.append(f"Gender {patient_gender} != Required {req_gender}")
-
-        # 3. Check Weight
-        # ---------------
-        patient_weight = patient.get("weight") # Extracted from demographics or labs usually? 
-        # For now demographics weight
-        weight_rule = inclusion.get("weight", {})
-        if patient_weight is not None and isinstance(weight_rule, dict):
-            w_min = weight_rule.get("min")
-            w_max = weight_rule.get("max")
-            if w_min is not None and patient_weight < w_min:
-                exclusion_hit = True
-                reasons.append(f"Weight {patient_weight} < Required Min {w_min}")
-            if w_max is not None and patient_weight > w_max:
-                exclusion_hit = True
-                reasons.append(f"Weight {patient_weight} > Required Max {w_max}")
-
-        # 4. Check Explicit Exclusion Diagnoses
-        # -------------------------------------
-        patient_diagnoses = set(d.lower() for d in patient.get("diagnoses", []))
-        # From LLM extraction, diagnoses are a list of strings (grounded)
-        exclusion_diagnoses = set(d.lower() for d in exclusion.get("diagnoses", []))
-        
-        common_diag = patient_diagnoses.intersection(exclusion_diagnoses)
-        if common_diag:
-            exclusion_hit = True
-            reasons.append(f"Excluded Diagnoses found: {list(common_diag)}")
-
-        # 5. Check Explicit Exclusion Medications
-        # ---------------------------------------
-        patient_meds = set(m.lower() for m in patient.get("medications", []))
-        exclusion_meds = set(m.lower() for m in exclusion.get("medications", []))
-        
-        common_meds = patient_meds.intersection(exclusion_meds)
-        if common_meds:
-            exclusion_hit = True
-            reasons.append(f"Excluded Medications found: {list(common_meds)}")
-
-        # 6. Check Lab Thresholds
-        # -----------------------
-        patient_labs = patient.get("labs", {})
-        
-        # Check both inclusion labs (failure = exclusion) and exclusion labs (hit = exclusion)
-        # Handle inclusion lab failures
-        inclusion_labs = inclusion.get("labs", {})
-        for lab_name, bounds in inclusion_labs.items():
-            if lab_name in patient_labs:
-                val = patient_labs[lab_name]
-                if "min" in bounds and bounds["min"] is not None and val < bounds["min"]:
-                    exclusion_hit = True
-                    reasons.append(f"Inclusion failed: {lab_name} {val} < min {bounds['min']}")
-                if "max" in bounds and bounds["max"] is not None and val > bounds["max"]:
-                    exclusion_hit = True
-                    reasons.append(f"Inclusion failed: {lab_name} {val} > max {bounds['max']}")
-
-        # Handle exclusion lab hits
-        exclusion_labs = exclusion.get("labs", {})
-        for lab_name, bounds in exclusion_labs.items():
-            if lab_name in patient_labs:
-                val = patient_labs[lab_name]
-                # Hit if in range of exclusion
-                if "min" in bounds and bounds["min"] is not None and "max" in bounds and bounds["max"] is not None:
-                    if bounds["min"] <= val <= bounds["max"]:
-                        exclusion_hit = True
-                        reasons.append(f"Exclusion Lab hit: {lab_name} {val} is in excluded range [{bounds['min']}, {bounds['max']}]")
-                elif "min" in bounds and bounds["min"] is not None and val >= bounds["min"]:
-                    exclusion_hit = True
-                    reasons.append(f"Exclusion Lab hit: {lab_name} {val} >= excluded min {bounds['min']}")
-                elif "max" in bounds and bounds["max"] is not None and val <= bounds["max"]:
-                    exclusion_hit = True
-                    reasons.append(f"Exclusion Lab hit: {lab_name} {val} <= excluded max {bounds['max']}")
-
-        if exclusion_hit:
-            patient["exclusion_reasons"] = reasons
+    for patient, patient_reasons in zip(patients, reasons):
+        if patient_reasons:
+            patient["exclusion_reasons"] = patient_reasons
             excluded_patients.append(patient)
-            exclusion_router_logger.log(f"Patient {patient['patient_id']}: Exclusion triggered. Reasons: {reasons}")
+            exclusion_router_logger.log(f"Patient {patient['patient_id']}: Exclusion triggered. Reasons: {patient_reasons}")
         else:
             eligible_patients.append(patient)
 
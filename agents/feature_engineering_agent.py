@@ -1,22 +1,34 @@
-import copy
-import spacy
-from typing import Dict, List, Any
+import pandas as pd
+from typing import Dict, List, Any, Tuple
 from utils.logger import feature_engineering_logger
+from utils.nlp import get_nlp, ground_texts
 
-# Global cache for NLP model
-_nlp = None
+# Lowercased gender spellings -> canonical value (others are left unchanged)
+_GENDER_MAP = {
+    "f": "female", "female": "female", "woman": "female", "women": "female",
+    "m": "male", "male": "male", "man": "male", "men": "male",
+}
 
-def get_nlp():
-    global _nlp
-    if _nlp is None:
-        try:
-            feature_engineering_logger.log("Loading SciSpaCy model en_core_sci_lg for feature engineering...")
-            _nlp = spacy.load("en_core_sci_lg")
-            feature_engineering_logger.log("Model loaded successfully.")
-        except OSError:
-            feature_engineering_logger.log("SciSpaCy model not found, skipping semantic grounding.")
-            _nlp = None
-    return _nlp
+def build_feature_tables(patients: List[Dict[str, Any]]) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Columnar view of the transformed patients for vectorized rule checks:
+    - patient_features: one row per patient (same order as `patients`)
+    - lab_values: long-form labs, one row per (patient_idx, lab_name, value)
+    """
+    patient_features = pd.DataFrame({
+        "patient_id": pd.Series([p.get("patient_id") for p in patients], dtype=object),
+        "age": pd.Series([p.get("age") for p in patients], dtype="float64"),
+        "gender": pd.Series([p.get("gender") for p in patients], dtype=object),
+        "weight": pd.Series([p.get("weight") for p in patients], dtype="float64"),
+        # Lowercased term sets for exclusion matching
+        "diagnoses_lc": pd.Series([frozenset(d.lower() for d in p.get("diagnoses", [])) for p in patients], dtype=object),
+        "medications_lc": pd.Series([frozenset(m.lower() for m in p.get("medications", [])) for p in patients], dtype=object),
+    })
+    lab_values = pd.DataFrame(
+        [(i, lab_name, val) for i, p in enumerate(patients) for lab_name, val in p.get("labs", {}).items()],
+        columns=["patient_idx", "lab_name", "value"],
+    ).astype({"patient_idx": "int64", "value": "float64"})
+    return patient_features, lab_values
 
 def feature_engineering_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -27,30 +39,28 @@ def feature_engineering_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     nlp = get_nlp()
     transformed_patients = []
 
+    # Ground every distinct diagnosis once, batched through nlp.pipe
+    grounding = {}
+    if nlp:
+        unique_diagnoses = list(dict.fromkeys(diag for patient in patients for diag in patient.get("diagnoses") or []))
+        grounding = dict(zip(unique_diagnoses, ground_texts(nlp, unique_diagnoses)))
+
     for patient in patients:
-        transformed = copy.deepcopy(patient)
+        # Shallow copy: raw_* data is read-only downstream, only diagnoses/labs are rebuilt below
+        transformed = dict(patient)
+        transformed["diagnoses"] = list(patient.get("diagnoses") or [])
 
         # 1. Normalize Gender
         if transformed.get("gender"):
             g = str(transformed["gender"]).lower()
-            if g in ["f", "female", "woman", "women"]:
-                transformed["gender"] = "female"
-            elif g in ["m", "male", "man", "men"]:
-                transformed["gender"] = "male"
+            if g in _GENDER_MAP:
+                transformed["gender"] = _GENDER_MAP[g]
 
         # 2. Semantic Grounding for Diagnoses
         # -----------------------------------
         if nlp and transformed.get("diagnoses"):
-            grounded_diagnoses = []
-            for diag in transformed["diagnoses"]:
-                doc = nlp(diag)
-                # Use the canonical entity text if found, otherwise keep original
-                if doc.ents:
-                    # Ground to the first/most likely medical entity
-                    grounded_diagnoses.append(doc.ents[0].text.strip().title())
-                else:
-                    grounded_diagnoses.append(diag.strip().title())
-            transformed["diagnoses"] = list(set(grounded_diagnoses))
+            # Use the canonical entity text if found, otherwise keep original
+            transformed["diagnoses"] = list(dict.fromkeys(grounding[diag] for diag in transformed["diagnoses"]))
 
         # 3. Dynamic Lab Mapping & Normalization
         # --------------------------------------
@@ -76,5 +86,6 @@ def feature_engineering_agent(state: Dict[str, Any]) -> Dict[str, Any]:
         transformed_patients.append(transformed)
 
     state["transformed_patients"] = transformed_patients
+    state["patient_features"], state["lab_values"] = build_feature_tables(transformed_patients)
     feature_engineering_logger.log(f"Semantic feature engineering complete for {len(transformed_patients)} patients.")
     return state
@@ -1,16 +1,49 @@
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import json
-import datetime
 import os
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from typing import Dict, List, Any, Optional
 from utils.logger import patient_ingestion_logger
 from utils.schemas import Patient
 
+# pandas' default NA strings, so the pyarrow reader treats missing cells the same way
+CSV_NA_VALUES = ['', '#N/A', '#N/A N/A', '#NA', '-1.#IND', '-1.#QNAN', '-NaN', '-nan', '1.#IND', '1.#QNAN',
+                 '<NA>', 'N/A', 'NA', 'NULL', 'NaN', 'None', 'n/a', 'nan', 'null']
+
+def read_csv_arrow(path: str) -> pd.DataFrame:
+    """
+    Parse a CSV with pyarrow's multi-threaded reader.
+    Column types are inferred from the first block; date/time columns are kept as text
+    (like pd.read_csv) so the raw records stay JSON-serializable.
+    """
+    with pa_csv.open_csv(path) as reader:
+        schema = reader.schema
+    text_columns = {field.name: pa.string() for field in schema if pa.types.is_temporal(field.type)}
+    convert_options = pa_csv.ConvertOptions(
+        column_types=text_columns,
+        null_values=CSV_NA_VALUES,
+        strings_can_be_null=True,
+    )
+    return pa_csv.read_csv(path, convert_options=convert_options).to_pandas()
+
 def load_csv_safely(path: str) -> pd.DataFrame:
     try:
-        df = pd.read_csv(path)
-        # Handle cases where pandas might read weird empty columns
-        df = df.loc[:, ~df.columns.str.contains('^Unnamed')]
+        try:
+            df = read_csv_arrow(path)
+        except pa.ArrowInvalid as e:
+            # Types inferred from the first block didn't hold for the whole file
+            patient_ingestion_logger.log(f"pyarrow could not parse {path} ({e}), falling back to pandas reader")
+            df = pd.read_csv(path)
+        # Handle cases where pandas might read weird empty columns (pyarrow leaves them unnamed)
+        df = df.loc[:, ~df.columns.str.contains('^Unnamed') & (df.columns != "")]
+        # Replace NaN with None in one vectorized pass (missing CSV cells are data errors)
+        nan_count = int(df.isna().sum().sum())
+        if nan_count:
+            patient_ingestion_logger.log(f"ERROR: {nan_count} NaN values detected in {path}. Treating as data errors (None).")
+        df = df.astype(object).where(df.notna(), None)
         patient_ingestion_logger.log(f"Loaded {path} with {len(df)} rows")
         return df
     except FileNotFoundError:
@@ -20,19 +53,6 @@ def load_csv_safely(path: str) -> pd.DataFrame:
         patient_ingestion_logger.log(f"Error loading {path}: {str(e)}")
         return pd.DataFrame()
 
-def clean_nans(data: Any, path: str = "") -> Any:
-    """
-    Recursively replace NaN with None and log each as an error.
-    """
-    if isinstance(data, dict):
-        return {k: clean_nans(v, f"{path}.{k}" if path else k) for k, v in data.items()}
-    elif isinstance(data, list):
-        return [clean_nans(v, f"{path}[{i}]") for i, v in enumerate(data)]
-    elif isinstance(data, float) and pd.isna(data):
-        patient_ingestion_logger.log(f"ERROR: NaN detected at {path}. Treating as data error.")
-        return None
-    return data
-
 def patient_ingestion_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     """
     Load ALL available patient CSVs, join on patient_id, normalize, and capture raw data.
@@ -41,10 +61,10 @@ def patient_ingestion_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     
     # 1. Discover and load all CSVs
     all_files = [f for f in os.listdir(data_dir) if f.endswith(".csv")]
-    dfs = {}
-    for f in all_files:
-        key = f.replace(".csv", "")
-        dfs[key] = load_csv_safely(os.path.join(data_dir, f))
+    # CSV parsing releases the GIL, so files are loaded on a thread pool
+    with ThreadPoolExecutor(max_workers=max(1, min(8, len(all_files)))) as executor:
+        loaded = executor.map(lambda f: load_csv_safely(os.path.join(data_dir, f)), all_files)
+        dfs = {f.replace(".csv", ""): df for f, df in zip(all_files, loaded)}
 
     patients_df = dfs.get("patients", pd.DataFrame())
     if patients_df.empty:
@@ -69,10 +89,15 @@ def patient_ingestion_agent(state: Dict[str, Any]) -> Dict[str, Any]:
                 patient_ingestion_logger.log(f"Skipping {key} grouping: No PATIENT or PATIENTID column found.")
                 continue
 
-            g_map = {}
-            for pid, group in df.groupby(join_key):
-                g_map[str(pid)] = group.to_dict("records")
-            maps[key] = g_map
+            # Single pass over the rows instead of groupby + per-group to_dict
+            cols = df.columns.tolist()
+            idx = cols.index(join_key)
+            g_map = defaultdict(list)
+            for row in df.itertuples(index=False, name=None):
+                pid = row[idx]
+                if pid is not None:
+                    g_map[str(pid)].append(dict(zip(cols, row)))
+            maps[key] = dict(g_map)
         return maps
 
     grouped_maps = get_grouped_maps(dfs)
@@ -81,37 +106,33 @@ def patient_ingestion_agent(state: Dict[str, Any]) -> Dict[str, Any]:
     def extract_desc_list(raw_list: List[Dict[str, Any]]) -> List[str]:
         return [str(item.get("DESCRIPTION", "")) for item in raw_list if item.get("DESCRIPTION")]
 
+    # Basic stats computed for all patients at once (unparseable birthdates -> None)
+    n_patients = len(patients_df)
+    ages = [None] * n_patients
+    if "BIRTHDATE" in patients_df.columns:
+        birthdates = pd.to_datetime(patients_df["BIRTHDATE"], format="%Y-%m-%d", errors="coerce")
+        age_days = (pd.Timestamp.today().normalize() - birthdates).dt.days
+        ages = [None if pd.isna(days) else int(days) // 365 for days in age_days]
+
+    genders = [None] * n_patients
+    if "GENDER" in patients_df.columns:
+        genders = [str(g).lower() if g else g for g in patients_df["GENDER"]]
+
     patients_json = []
+    columns = patients_df.columns.tolist()
     
     # Iterate through patients
-    for _, row in patients_df.iterrows():
-        patient_id = row.get("Id")
-        if pd.isna(patient_id):
+    for row, age, gender in zip(patients_df.itertuples(index=False, name=None), ages, genders):
+        # 1. Demographics are the patients.csv record itself
+        demographics = dict(zip(columns, row))
+        patient_id = demographics.get("Id")
+        if patient_id is None:
             continue
         patient_id = str(patient_id)
 
-        # 1. Demographics
-        demographics = row.to_dict()
-        demographics = clean_nans(demographics, f"Patient:{patient_id}.Demographics")
-
-        # 2. Basic Stats
-        birthdate_str = demographics.get("BIRTHDATE")
-        age = None
-        if birthdate_str:
-            try:
-                birthdate = datetime.datetime.strptime(birthdate_str, '%Y-%m-%d').date()
-                today = datetime.date.today()
-                age = (today - birthdate).days // 365
-            except ValueError:
-                pass
-        
-        gender = demographics.get("GENDER")
-        if gender: gender = str(gender).lower()
-
-        # 3. Retrieve and clean ALL categories
+        # 2. Retrieve ALL categories
         def get_clean_raw(key: str):
-            data = grouped_maps.get(key, {}).get(patient_id, [])
-            return clean_nans(data, f"Patient:{patient_id}.{key.title()}")
+            return grouped_maps.get(key, {}).get(patient_id, [])
 
         raw_data = {
             "raw_observations": get_clean_raw("observations"),
@@ -129,7 +150,7 @@ def patient_ingestion_agent(state: Dict[str, Any]) -> Dict[str, Any]:
             "raw_payer_transitions": get_clean_raw("payer_transitions"),
         }
 
-        # 4. Extract simplified fields for logic
+        # 3. Extract simplified fields for logic
         diagnoses = extract_desc_list(raw_data["raw_conditions"])
         meds = extract_desc_list(raw_data["raw_medications"])
         procs = extract_desc_list(raw_data["raw_procedures"])
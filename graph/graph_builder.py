@@ -1,3 +1,4 @@
+import functools
 from langgraph.graph import StateGraph, END
 from graph.state import PipelineState
 from agents.patient_ingestion_agent import patient_ingestion_agent
@@ -5,9 +6,9 @@ from agents.drug_rule_extraction_agent import drug_rule_extraction_agent
 from agents.feature_engineering_agent import feature_engineering_agent
 from agents.exclusion_router_agent import exclusion_router_agent
 from agents.eligibility_reasoning_agent import eligibility_reasoning_agent
-from utils.logger import PipelineLogger
+from utils.logger import get_logger
 
-logger = PipelineLogger("GraphBuilder")
+logger = get_logger("GraphBuilder")
 
 def route_exclusion(state: PipelineState):
     """
@@ -25,7 +26,7 @@ def build_graph():
     """
     graph = StateGraph(PipelineState)
 
-    # Add nodes
+    # Add nodes (the rule extraction and reasoning agents are async)
     graph.add_node("patient_ingestion", patient_ingestion_agent)
     graph.add_node("drug_rule_extraction", drug_rule_extraction_agent)
     graph.add_node("feature_engineering", feature_engineering_agent)
@@ -54,3 +55,10 @@ def build_graph():
 
     logger.log("LangGraph built successfully")
     return graph
+
+@functools.lru_cache(maxsize=1)
+def get_compiled_graph():
+    """
+    Build and compile the pipeline graph once per process and reuse it across runs.
+    """
+    return build_graph().compile()
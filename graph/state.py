@@ -1,3 +1,4 @@
+import pandas as pd
 from typing import TypedDict, Dict, List, Any
 
 class PipelineState(TypedDict):
@@ -5,6 +6,10 @@ class PipelineState(TypedDict):
     patients_json: List[Dict[str, Any]]
     trial_rules: Dict[str, Any]
     transformed_patients: List[Dict[str, Any]]
+    # Columnar view of transformed_patients (row i = transformed_patients[i])
+    patient_features: pd.DataFrame
+    # Long-form labs: patient_idx, lab_name, value
+    lab_values: pd.DataFrame
     eligible_patients: List[Dict[str, Any]]
     excluded_patients: List[Dict[str, Any]]
     current_patient: Dict[str, Any]
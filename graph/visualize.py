@@ -1,23 +1,26 @@
-from graph.graph_builder import build_graph
-import matplotlib.pyplot as plt
+from graph.graph_builder import get_compiled_graph
+from utils.logger import flush_logs
 
-def visualize_graph():
+def visualize_graph(app=None):
     """
     Generate and save the graph visualization as pipeline_graph.png
+    Pass the already compiled `app` to reuse it; otherwise the shared compiled graph is used.
     """
+    # Keep these prints in order with the (buffered) pipeline log
+    flush_logs()
     try:
-        graph = build_graph()
-        app = graph.compile()
+        if app is None:
+            app = get_compiled_graph()
 
         # Generate the PNG using pygraphviz or similar
         # If this fails, we skip visualization but don't stop the pipeline
         png_data = app.get_graph().draw_png()
         with open("pipeline_graph.png", "wb") as f:
             f.write(png_data)
-        print("Graph visualization saved as pipeline_graph.png")
+        print("Graph visualization saved as pipeline_graph.png", flush=True)
     except Exception as e:
-        print(f"Warning: Could not generate visualization: {e}")
-        print("Tip: Install pygraphviz (requires graphviz-dev) or use mermaid output.")
+        print(f"Warning: Could not generate visualization: {e}", flush=True)
+        print("Tip: Install pygraphviz (requires graphviz-dev) or use mermaid output.", flush=True)
 
 if __name__ == "__main__":
     visualize_graph()
@@ -1,8 +1,56 @@
-from graph.graph_builder import build_graph
-from graph.visualize import visualize_graph
-from utils.logger import PipelineLogger
+import asyncio
+import json
+import logging
+import os
+from graph.graph_builder import get_compiled_graph
+from utils.logger import get_logger
 
-logger = PipelineLogger("Main")
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+logger = get_logger("Main")
+
+OUTPUT_DIR = "output"
+
+def to_json_bytes(data) -> bytes:
+    """
+    Serialize `data` as indented JSON. Uses orjson (serializes in C into one buffer)
+    when installed, otherwise the standard json module.
+    """
+    if orjson is not None:
+        return orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS)
+    return json.dumps(data, indent=2).encode("utf-8")
+
+def write_json(path: str, data) -> None:
+    """
+    Write a whole artifact with a single write() on a raw descriptor
+    (the payload is already one buffer, so no file object buffering is needed).
+    """
+    payload = memoryview(to_json_bytes(data))
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        while payload:
+            payload = payload[os.write(fd, payload):]
+    finally:
+        os.close(fd)
+
+def log_patient_detail(item: dict) -> None:
+    """Print one report record as a single multi-line log entry."""
+    get = item.get
+    lines = [f"Patient {item['patient_id']} | Status: {item['status']}"]
+    reasons = get("reasons")
+    if reasons is not None:
+        lines.append(f"  - Hard Reasons: {reasons}")
+    reasoning = get("reasoning")
+    if reasoning:
+        lines.append(f"  - Reasoning: {reasoning}")
+    summary = get("summary")
+    if summary is not None:
+        lines.append(f"  - Summary: {summary}")
+    lines.append("-" * 30)
+    logger.log("\n".join(lines))
 
 def main():
     """
@@ -10,18 +58,21 @@ def main():
     """
     logger.log("Starting clinical trial eligibility pipeline")
 
-    # Visualize the graph
-    visualize_graph()
+    # Build (once per process) and run the graph
+    app = get_compiled_graph()
 
-    # Build and run the graph
-    graph = build_graph()
-    app = graph.compile()
+    # Visualize the graph (opt-in, it is not needed for the pipeline output)
+    if os.environ.get("PIPELINE_VIZ") == "1":
+        from graph.visualize import visualize_graph
+        visualize_graph(app)
 
     initial_state = {
         "raw_patient_tables": {},
         "patients_json": [],
         "trial_rules": {},
         "transformed_patients": [],
+        "patient_features": None,
+        "lab_values": None,
         "eligible_patients": [],
         "excluded_patients": [],
         "current_patient": {},
@@ -30,71 +81,87 @@ def main():
         "logs": []
     }
 
-    final_state = app.invoke(initial_state)
+    # LLM agents are async nodes, so the graph must be run with ainvoke
+    final_state = asyncio.run(app.ainvoke(initial_state))
 
     # 1. Save Raw Patient Data (Retrieved from CSV)
-    import json
-    import os
-    os.makedirs("output", exist_ok=True)
+    os.makedirs(OUTPUT_DIR, exist_ok=True)
+    raw_patients_path = os.path.join(OUTPUT_DIR, "raw_patients.json")
+    trial_rules_path = os.path.join(OUTPUT_DIR, "trial_rules.json")
+    eligibility_path = os.path.join(OUTPUT_DIR, "eligibility_results.json")
     
-    with open("output/raw_patients.json", "w") as f:
-        # 'patients_json' contains the structured data retrieved directly from CSVs
-        json.dump(final_state.get("patients_json", []), f, indent=2)
-    logger.log("Raw patient data (from CSV) saved to output/raw_patients.json")
+    # 'patients_json' contains the structured data retrieved directly from CSVs
+    write_json(raw_patients_path, final_state.get("patients_json", []))
+    logger.log(f"Raw patient data (from CSV) saved to {raw_patients_path}")
 
     # 2. Save Drug Extracted Portion
-    with open("output/trial_rules.json", "w") as f:
-        json.dump(final_state.get("trial_rules", {}), f, indent=2)
-    logger.log("Extracted trial rules saved to output/trial_rules.json")
+    write_json(trial_rules_path, final_state.get("trial_rules", {}))
+    logger.log(f"Extracted trial rules saved to {trial_rules_path}")
 
     # 3. Save Final Eligibility & Reasoning Details
-    # We combine eligible and excluded reports here
-    eligibility_details = []
-    
-    for p in final_state.get("eligible_patients", []):
-        eligibility_details.append({
-            "patient_id": p.get("patient_id"),
-            "status": "Eligible" if p.get("eligibility_result", {}).get("eligible") else "Ineligible (Pass Exclusion, Fail Inclusion)",
-            "confidence": p.get("eligibility_result", {}).get("confidence"),
-            "reasoning": p.get("eligibility_result", {}).get("reasoning"),
-            "summary": p.get("eligibility_result", {}).get("summary")
-        })
-        
-    for p in final_state.get("excluded_patients", []):
-        eligibility_details.append({
-            "patient_id": p.get("patient_id"),
-            "status": "Excluded (Deterministic)",
-            "reasons": p.get("exclusion_reasons", []),
-            "summary": "Failed hard exclusion criteria"
-        })
-
-    with open("output/eligibility_results.json", "w") as f:
-        json.dump(eligibility_details, f, indent=2)
-    logger.log("Detailed eligibility reasoning saved to output/eligibility_results.json")
+    # We combine eligible and excluded reports here. Records are streamed to the file
+    # (and printed) one at a time; summary counts are taken in the same pass.
+    eligible_count = 0
+    eligible_patients = final_state.get("eligible_patients", [])
+    excluded_patients = final_state.get("excluded_patients", [])
+
+    with open(eligibility_path, "wb", buffering=1 << 20) as f:
+        write = f.write
+        separator = b"[\n"
+
+        def emit(item: dict) -> None:
+            nonlocal separator
+            write(separator)
+            # Nest the record one level, as it would be inside an indented array
+            write(b"\n".join(b"  " + line for line in to_json_bytes(item).split(b"\n")))
+            separator = b",\n"
+            log_patient_detail(item)
+
+        for p in eligible_patients:
+            result = p.get("eligibility_result") or {}
+            get_result = result.get
+            is_eligible = bool(get_result("eligible"))
+            eligible_count += is_eligible
+            emit({
+                "patient_id": p.get("patient_id"),
+                "status": "Eligible" if is_eligible else "Ineligible (Pass Exclusion, Fail Inclusion)",
+                "confidence": get_result("confidence"),
+                "reasoning": get_result("reasoning"),
+                "summary": get_result("summary")
+            })
+
+        for p in excluded_patients:
+            emit({
+                "patient_id": p.get("patient_id"),
+                "status": "Excluded (Deterministic)",
+                "reasons": p.get("exclusion_reasons", []),
+                "summary": "Failed hard exclusion criteria"
+            })
+
+        # An empty report is still a valid (empty) array
+        write(b"[]" if separator == b"[\n" else b"\n]")
+
+    logger.log(f"Detailed eligibility reasoning saved to {eligibility_path}")
 
     # --- Console Output ---
-    eligible_count = len([p for p in final_state.get("eligible_patients", []) if p.get("eligibility_result", {}).get("eligible")])
-    excluded_count = len(final_state.get("excluded_patients", []))
-    ineligible_but_not_excluded = len([p for p in final_state.get("eligible_patients", []) if not p.get("eligibility_result", {}).get("eligible")])
+    # Patients that passed exclusion are either eligible or soft-ineligible
+    ineligible_but_not_excluded = len(eligible_patients) - eligible_count
+    excluded_count = len(excluded_patients)
     
-    logger.log(f"\n" + "="*50)
-    logger.log(f"FINAL PIPELINE SUMMARY")
-    logger.log(f"="*50)
-    logger.log(f"Total Patients: {len(final_state.get('patients_json', []))}")
-    logger.log(f"Eligible: {eligible_count}")
-    logger.log(f"Ineligible (Soft): {ineligible_but_not_excluded}")
-    logger.log(f"Excluded (Hard): {excluded_count}")
-    logger.log(f"="*50)
-
-    for item in eligibility_details:
-        logger.log(f"Patient {item['patient_id']} | Status: {item['status']}")
-        if "reasons" in item:
-            logger.log(f"  - Hard Reasons: {item['reasons']}")
-        if "reasoning" in item and item["reasoning"]:
-            logger.log(f"  - Reasoning: {item['reasoning']}")
-        if "summary" in item:
-            logger.log(f"  - Summary: {item['summary']}")
-        logger.log("-" * 30)
+    logger.log("\n".join([
+        "",
+        "=" * 50,
+        "FINAL PIPELINE SUMMARY",
+        "=" * 50,
+        f"Total Patients: {len(final_state.get('patients_json', []))}",
+        f"Eligible: {eligible_count}",
+        f"Ineligible (Soft): {ineligible_but_not_excluded}",
+        f"Excluded (Hard): {excluded_count}",
+        "=" * 50,
+    ]))
+
+    # Flush the buffered log output
+    logging.shutdown()
 
 if __name__ == "__main__":
     main()
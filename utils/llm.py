@@ -0,0 +1,34 @@
+import asyncio
+import os
+from typing import List, Union
+from ollama import AsyncClient
+from utils.logger import flush_logs
+
+LLM_MODEL = "llama3.1:latest"
+
+# Max number of requests kept in flight against the Ollama server.
+# Set it to the same value as the server's OLLAMA_NUM_PARALLEL so requests
+# overlap inside the server instead of queueing behind each other.
+OLLAMA_NUM_PARALLEL = int(os.environ.get("OLLAMA_NUM_PARALLEL", "4"))
+
+# Context window (tokens) requested for every call. Ollama's default is much smaller and
+# silently truncates long prompts, so callers size their prompts against this value.
+LLM_NUM_CTX = int(os.environ.get("OLLAMA_NUM_CTX", "8192"))
+
+async def generate_all(prompts: List[str]) -> List[Union[str, BaseException]]:
+    """
+    Send all prompts to the LLM concurrently (bounded by OLLAMA_NUM_PARALLEL).
+    Ollama's JSON mode is on, so responses are bare JSON documents.
+    Results keep the order of `prompts`; a failed request yields its exception.
+    """
+    # LLM calls can take minutes; show the progress logged so far
+    flush_logs()
+    client = AsyncClient()
+    semaphore = asyncio.Semaphore(max(1, OLLAMA_NUM_PARALLEL))
+
+    async def generate(prompt: str) -> str:
+        async with semaphore:
+            response = await client.generate(model=LLM_MODEL, prompt=prompt, format="json", options={"temperature": 0, "num_ctx": LLM_NUM_CTX})
+            return response["response"]
+
+    return await asyncio.gather(*(generate(p) for p in prompts), return_exceptions=True)
@@ -1,22 +1,72 @@
+import atexit
+import io
 import logging
 import sys
+import time
+from typing import Dict
+
+def _buffered_stdout():
+    """
+    Block-buffered (64 KiB) text stream on stdout's file descriptor, so log lines are
+    written in batches instead of one write() per line when output goes to a file or pipe.
+    Interactive terminals keep the line-buffered sys.stdout so progress shows up live.
+    Falls back to sys.stdout when it has no real file descriptor (e.g. captured output).
+    """
+    try:
+        if sys.stdout.isatty():
+            return sys.stdout
+        stream = open(sys.stdout.fileno(), "w", buffering=65536, encoding=sys.stdout.encoding,
+                      errors=sys.stdout.errors, closefd=False)
+    except (AttributeError, OSError, ValueError, io.UnsupportedOperation):
+        return sys.stdout
+    atexit.register(stream.flush)
+    return stream
+
+# Shared by all pipeline loggers
+_log_stream = _buffered_stdout()
+
+def flush_logs() -> None:
+    """Write out buffered log lines (call before long waits or before printing to stdout directly)."""
+    _log_stream.flush()
+
+# The log format doesn't use thread/process fields, so don't collect them per record
+logging.logThreads = False
+logging.logProcesses = False
+logging.logMultiprocessing = False
+
+class PipelineFormatter(logging.Formatter):
+    """
+    Renders '%(asctime)s - %(name)s - %(message)s' with a single f-string
+    instead of the generic %-style substitution.
+    """
+    def format(self, record: logging.LogRecord) -> str:
+        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(record.created))
+        return f"{timestamp},{int(record.msecs):03d} - {record.name} - {record.getMessage()}"
 
 class PipelineLogger:
     def __init__(self, name: str):
         self.logger = logging.getLogger(name)
         self.logger.setLevel(logging.INFO)
-        handler = logging.StreamHandler(sys.stdout)
-        formatter = logging.Formatter('%(asctime)s - %(name)s - %(message)s')
-        handler.setFormatter(formatter)
+        handler = logging.StreamHandler(_log_stream)
+        handler.setFormatter(PipelineFormatter())
         if not self.logger.handlers:
             self.logger.addHandler(handler)
 
     def log(self, message: str):
         self.logger.info(message)
 
+# One PipelineLogger per name, shared by every module that asks for it
+_LOGGERS: Dict[str, PipelineLogger] = {}
+
+def get_logger(name: str) -> PipelineLogger:
+    logger = _LOGGERS.get(name)
+    if logger is None:
+        logger = _LOGGERS[name] = PipelineLogger(name)
+    return logger
+
 # Global logger instances for each agent
-patient_ingestion_logger = PipelineLogger("PatientIngestion")
-drug_rule_extraction_logger = PipelineLogger("RuleExtraction")
-feature_engineering_logger = PipelineLogger("FeatureEngineering")
-exclusion_router_logger = PipelineLogger("ExclusionRouter")
-eligibility_reasoning_logger = PipelineLogger("EligibilityReasoning")
+patient_ingestion_logger = get_logger("PatientIngestion")
+drug_rule_extraction_logger = get_logger("RuleExtraction")
+feature_engineering_logger = get_logger("FeatureEngineering")
+exclusion_router_logger = get_logger("ExclusionRouter")
+eligibility_reasoning_logger = get_logger("EligibilityReasoning")
@@ -0,0 +1,36 @@
+import functools
+import spacy
+from typing import List
+from utils.logger import get_logger
+
+# Logger for model loading
+nlp_logger = get_logger("NLP")
+
+# Number of texts per nlp.pipe batch
+NLP_BATCH_SIZE = 256
+
+@functools.lru_cache(maxsize=1)
+def get_nlp():
+    """
+    Load the SciSpaCy model once per process and share it across agents.
+    Only NER is used (doc.ents), so the tagger/parser/lemmatizer pipes are disabled.
+    Returns None if the model is not installed.
+    """
+    try:
+        nlp_logger.log("Loading SciSpaCy model en_core_sci_lg...")
+        nlp = spacy.load("en_core_sci_lg", disable=["tagger", "parser", "lemmatizer"])
+        nlp_logger.log("Model loaded successfully.")
+        return nlp
+    except OSError:
+        nlp_logger.log("SciSpaCy model not found, skipping entity grounding.")
+        return None
+
+def ground_texts(nlp, texts: List[str]) -> List[str]:
+    """
+    Ground each text to its first recognised medical entity (title-cased),
+    falling back to the text itself. Texts are batched through nlp.pipe.
+    """
+    return [
+        (doc.ents[0].text if doc.ents else text).strip().title()
+        for text, doc in zip(texts, nlp.pipe(texts, batch_size=NLP_BATCH_SIZE))
+    ]
@@ -1,10 +1,68 @@
 import json
 import re
-from typing import Optional, Any
-from utils.logger import PipelineLogger
+from collections import OrderedDict
+from typing import Optional, Any, Type, TypeVar
+from pydantic import BaseModel, ValidationError
+from utils.logger import get_logger
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+M = TypeVar("M", bound=BaseModel)
 
 # Logger for parsing issues
-parser_logger = PipelineLogger("JSONParser")
+parser_logger = get_logger("JSONParser")
+
+def _jloads(text: str) -> Any:
+    """
+    orjson.loads when available. orjson rejects NaN/Infinity and out-of-range numbers,
+    which json.loads accepts, so those documents fall back to json.loads.
+    """
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+# Cleanup patterns, compiled once
+_COMMENT_RE = re.compile(r'//.*?\n')
+_TRAILING_COMMA_RE = re.compile(r',\s*([\]}])')
+# Outermost object / array in a response (greedy: first opener to last closer)
+_JSON_OBJ_RE = re.compile(r'\{.*\}', re.DOTALL)
+_JSON_ARR_RE = re.compile(r'\[.*\]', re.DOTALL)
+
+# Recently parsed responses -> the JSON text that parsed for them (LRU).
+# A repeated response is re-parsed from that text, skipping the cleanup cascade;
+# re-parsing (instead of caching the objects) gives each caller its own copy.
+PARSE_CACHE_SIZE = 512
+_parse_cache: "OrderedDict[str, str]" = OrderedDict()
+# Extracted {...} blocks -> their cleaned JSON text (LRU), so the same block inside
+# different surrounding prose skips the cleanup substitutions
+CLEAN_CACHE_SIZE = 256
+_clean_cache: "OrderedDict[str, str]" = OrderedDict()
+
+def _lru_get(cache: "OrderedDict[str, str]", key: str) -> Optional[str]:
+    value = cache.get(key)
+    if value is not None:
+        cache.move_to_end(key)
+    return value
+
+def _lru_put(cache: "OrderedDict[str, str]", key: str, value: str, max_size: int) -> None:
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+def _remember(text: str, json_text: str, block: Optional[str] = None) -> Any:
+    """Parse json_text and remember it as the clean form of `text` (and of the extracted `block`)."""
+    data = _jloads(json_text)
+    _lru_put(_parse_cache, text, json_text, PARSE_CACHE_SIZE)
+    if block is not None:
+        _lru_put(_clean_cache, block, json_text, CLEAN_CACHE_SIZE)
+    return data
 
 def robust_json_load(text: str, component_name: str = "Unknown") -> Optional[Any]:
     """
@@ -13,27 +71,46 @@ def robust_json_load(text: str, component_name: str = "Unknown") -> Optional[Any
     """
     if not text or not isinstance(text, str):
         return None
+    # No object or array anywhere: nothing to extract
+    if '{' not in text and '[' not in text:
+        return None
 
-    try:
-        # 1. Try direct load first
-        return json.loads(text.strip())
-    except Exception:
-        pass
+    # Repeated response: re-parse the JSON text that worked last time
+    cached = _lru_get(_parse_cache, text)
+    if cached is not None:
+        return _jloads(cached)
+
+    # 1. Try direct load first, but only if the text looks like bare JSON
+    # (bounds are scanned instead of strip() so the text isn't copied twice)
+    i, j = 0, len(text)
+    while i < j and text[i].isspace():
+        i += 1
+    while j > i and text[j-1].isspace():
+        j -= 1
+    if i < j and text[i] in "{[":
+        try:
+            return _remember(text, text[i:j])
+        except Exception:
+            pass
 
-    # 2. Extract content between first { and last }
+    # 2. Extract content between first { and last } (or [ and ] for array responses)
+    match = _JSON_OBJ_RE.search(text) or _JSON_ARR_RE.search(text)
     try:
-        start = text.find('{')
-        end = text.rfind('}')
-        if start != -1 and end != -1:
-            clean_json = text[start:end+1]
+        if match:
+            block = match.group(0)
+            cleaned = _lru_get(_clean_cache, block)
+            if cleaned is not None:
+                return _remember(text, cleaned)
+
+            clean_json = block
             
             # Remove markdown markers and comments
             clean_json = clean_json.replace("```json", "").replace("```", "").strip()
             # Filter out single line comments
-            clean_json = re.sub(r'//.*?\n', '\n', clean_json)
+            clean_json = _COMMENT_RE.sub('\n', clean_json)
             
             try:
-                return json.loads(clean_json)
+                return _remember(text, clean_json, block)
             except Exception:
                 # 3. Last ditch: simple character replacements for common LLM quirks
                 try:
@@ -42,8 +119,8 @@ def robust_json_load(text: str, component_name: str = "Unknown") -> Optional[Any
                     # We only do this if the standard load fails
                     fix_json = clean_json.replace("\'", "\"")
                     # Remove trailing commas before closing braces/brackets
-                    fix_json = re.sub(r',\s*([\]}])', r'\1', fix_json)
-                    return json.loads(fix_json)
+                    fix_json = _TRAILING_COMMA_RE.sub(r'\1', fix_json)
+                    return _remember(text, fix_json, block)
                 except Exception as e:
                     parser_logger.log(f"CRITICAL: Failed to parse JSON for {component_name}. Raw text snapshot: {text[:200]}... Error: {e}")
                     return None
@@ -52,3 +129,26 @@ def robust_json_load(text: str, component_name: str = "Unknown") -> Optional[Any
         return None
     
     return None
+
+def parse_model(model: Type[M], text: str, component_name: str = "Unknown") -> Optional[M]:
+    """
+    Parse an LLM response straight into a Pydantic model.
+    Clean JSON is validated in a single pass with model_validate_json;
+    anything else goes through robust_json_load first.
+    """
+    if not text or not isinstance(text, str):
+        return None
+
+    try:
+        return model.model_validate_json(text)
+    except ValidationError:
+        pass
+
+    data = robust_json_load(text, component_name=component_name)
+    if data is None:
+        return None
+    try:
+        return model.model_validate(data)
+    except ValidationError as e:
+        parser_logger.log(f"Schema validation failed for {component_name}: {e}")
+        return None
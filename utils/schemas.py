@@ -1,39 +1,47 @@
-from pydantic import BaseModel
-from typing import Dict, List, Optional, Any
+from pydantic import BaseModel, Field
+from typing import Dict, List, Optional, Any, Union
 
 class Patient(BaseModel):
     patient_id: str
     age: Optional[int] = None
     gender: Optional[str] = None
-    diagnoses: List[str] = []
-    procedures: List[str] = []
-    medications: List[str] = []
-    labs: Dict[str, float] = {}
+    diagnoses: List[str] = Field(default_factory=list)
+    procedures: List[str] = Field(default_factory=list)
+    medications: List[str] = Field(default_factory=list)
+    labs: Dict[str, float] = Field(default_factory=dict)
     
     # Comprehensive raw data storage from ALL CSVs
-    raw_observations: List[Dict[str, Any]] = []
-    raw_conditions: List[Dict[str, Any]] = []
-    raw_medications: List[Dict[str, Any]] = []
-    raw_procedures: List[Dict[str, Any]] = []
-    raw_allergies: List[Dict[str, Any]] = []
-    raw_careplans: List[Dict[str, Any]] = []
-    raw_claims: List[Dict[str, Any]] = []
-    raw_devices: List[Dict[str, Any]] = []
-    raw_encounters: List[Dict[str, Any]] = []
-    raw_imaging_studies: List[Dict[str, Any]] = []
-    raw_immunizations: List[Dict[str, Any]] = []
-    raw_supplies: List[Dict[str, Any]] = []
-    raw_payer_transitions: List[Dict[str, Any]] = []
+    raw_observations: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_conditions: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_medications: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_procedures: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_allergies: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_careplans: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_claims: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_devices: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_encounters: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_imaging_studies: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_immunizations: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_supplies: List[Dict[str, Any]] = Field(default_factory=list)
+    raw_payer_transitions: List[Dict[str, Any]] = Field(default_factory=list)
     
-    demographics: Dict[str, Any] = {}
+    demographics: Dict[str, Any] = Field(default_factory=dict)
 
 class TrialRules(BaseModel):
     trial_id: str
-    inclusion: Dict[str, Any] = {}
-    exclusion: Dict[str, Any] = {}
+    inclusion: Dict[str, Any] = Field(default_factory=dict)
+    exclusion: Dict[str, Any] = Field(default_factory=dict)
+
+class ExtractedRules(BaseModel):
+    """Raw LLM rule extraction for a single trial document."""
+    inclusion: Dict[str, Any] = Field(default_factory=dict)
+    exclusion: Dict[str, Any] = Field(default_factory=dict)
 
 class EligibilityResult(BaseModel):
-    eligible: bool
-    confidence: float
-    reasoning: List[str]
-    summary: str
+    eligible: bool = False
+    confidence: float = 0.0
+    reasoning: List[str] = Field(default_factory=lambda: ["Reasoning could not be parsed"])
+    summary: str = "No summary provided."
+
+class PatientEligibility(EligibilityResult):
+    patient_id: Union[str, int]